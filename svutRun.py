@@ -23,34 +23,54 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-# pylint: disable=W0621
+# pylint: disable=W0621,C0415
 
+# Only the modules needed to parse the arguments are imported here, the
+# others are imported where used to keep short paths like -version fast
 import os
 import sys
+import re
 import argparse
-import filecmp
-import subprocess
-import datetime
-from timeit import default_timer as timer
-from datetime import timedelta
 
 SCRIPTDIR = os.path.abspath(os.path.dirname(__file__))
 
+# Duration in seconds while the SVUT version read from git is reused
+GIT_TAG_CACHE_TIMEOUT = 60
+
+# Testbench file names detected when scanning the current folder, either
+# with a prefix like tb_ffd.sv or a suffix like ffd_tb.sv
+TB_RE = re.compile(r"^(tb_|ts_|testbench_|testsuite_|unit_test_).*\.s?v$|"
+                   r".*(_unit_test|_testbench|_testsuite|_tb|_ts)\.s?v$")
+
+# Files included by a Verilog source, like `include "svut_h.sv"
+INCLUDE_RE = re.compile(r'`include\s+"([^"]+)"')
+
+# Names accepted by -sim to select Icarus Verilog
+ICARUS = ("icarus", "iverilog")
+
+# Static options passed to every Verilator build
+VERILATOR_FLAGS = ("-Wall", "--trace", "+1800-2012ext+sv", "+1800-2005ext+v",
+                   "-Wno-STMTDLY", "-Wno-UNUSED", "-Wno-UNDRIVEN",
+                   "-Wno-PINCONNECTEMPTY", "-Wpedantic", "-Wno-VARHIDDEN",
+                   "-Wno-lint", "-cc", "--exe", "--build")
+
 
 def check_arguments(args):
     """
     Verify the arguments are correctly setup
     """
 
-    if "iverilog" in args.simulator or "icarus" in args.simulator:
+    # The simulator name is already checked and lowered by the parser
+    if args.simulator in ICARUS:
         print_event("Run with Icarus Verilog")
-    elif "verilator" in args.simulator:
-        print_event("Run with Verilator")
+        args.simulator_bin = find_binary("iverilog", args)
+        args.vvp_bin = find_binary("vvp", args)
     else:
-        print_event("ERROR: Simulator not supported")
-        sys.exit(1)
+        print_event("Run with Verilator")
+        args.simulator_bin = find_binary("verilator", args)
 
-    if args.test == "":
+    # -test can be passed without value
+    if not args.test:
         print_event("ERROR: No testcase passed")
         sys.exit(1)
 
@@ -65,6 +85,34 @@ def check_arguments(args):
     return 0
 
 
+def find_binary(name, args):
+    """
+    Return the path of a simulator binary found in PATH. A dry run only
+    prints the commands, so the name is kept if the binary is missing
+    """
+
+    import shutil
+
+    path = shutil.which(name)
+
+    if path:
+        return path
+
+    if args.dry:
+        return name
+
+    print_event("ERROR: " + name + " not found in PATH")
+    sys.exit(1)
+
+
+def get_testname(test):
+    """
+    Return the testbench name, its file name without folder and extension
+    """
+
+    return os.path.basename(test).split(".")[0]
+
+
 def check_tb_extension(test):
     """
     Check the extension to be sure it can be run
@@ -79,13 +127,23 @@ def copy_svut_h():
     First copy svut_h.sv macro in the user folder if not present or different
     """
 
+    import shutil
+
     org_hfile = SCRIPTDIR + "/svut_h.sv"
     curr_hfile = os.getcwd() + "/svut_h.sv"
 
-    if (not os.path.isfile(curr_hfile)) or\
-            (not filecmp.cmp(curr_hfile, org_hfile)):
-        print("INFO: Copy up-to-date version of svut_h.sv")
-        os.system("cp " + org_hfile + " " + os.getcwd())
+    # A copy done by SVUT keeps the size and modification time of the original
+    try:
+        org_stat, curr_stat = os.stat(org_hfile), os.stat(curr_hfile)
+        if org_stat.st_size == curr_stat.st_size and \
+                int(org_stat.st_mtime) == int(curr_stat.st_mtime):
+            return 0
+    except FileNotFoundError:
+        pass
+
+    print("INFO: Copy up-to-date version of svut_h.sv")
+    shutil.copyfile(org_hfile, curr_hfile)
+    shutil.copystat(org_hfile, curr_hfile)
 
     return 0
 
@@ -96,25 +154,13 @@ def find_unit_tests():
     and return a list of available tests
     """
 
-    supported_prefix = ["tb_", "ts_", "testbench_", "testsuite_", "unit_test_"]
-    supported_suffix = ["_unit_test.v", "_unit_test.sv",
-                        "_testbench.v", "_testbench.sv",
-                        "_testsuite.v", "_testsuite.sv",
-                        "_tb.v", "_tb.sv", "_ts.v", "_ts.sv"]
     files = []
-    # Parse the current folder
-    for _file in os.listdir(os.getcwd()):
-        # Check only the files
-        if os.path.isfile(_file):
-            for suffix in supported_suffix:
-                if _file.endswith(suffix):
-                    files.append(_file)
-            for prefix in supported_prefix:
-                if _file.startswith(prefix):
-                    files.append(_file)
-
-    # Remove duplicated file if contains both prefix and suffix
-    files = list(set(files))
+    # Parse the current folder, checking only the files
+    with os.scandir(".") as entries:
+        for entry in entries:
+            if entry.is_file() and TB_RE.match(entry.name):
+                files.append(entry.name)
+
     return files
 
 
@@ -148,28 +194,114 @@ def helper(tag):
 
 def get_defines(defines):
     """
-    Return a string with the list of defines ready to drop in icarus
+    Return the list of defines ready to drop in the simulator command
+    """
+
+    return ["-D" + _def for _def in defines.split(';') if _def] if defines else []
+
+
+def sources_newer_than(target, sources):
+    """
+    Return True if one of the existing sources was modified after target
+    """
+
+    target_mtime = os.path.getmtime(target)
+
+    return any(os.path.getmtime(src) > target_mtime for src in sources if os.path.exists(src))
+
+
+def get_includes(path, incdirs, sources):
+    """
+    Add to sources the files included by a Verilog file, recursively.
+    Bytes which aren't valid UTF-8 are kept, to find the file they name.
+    An include is looked up from the folder of the including file,
+    the current folder and the include folders
+    """
+
+    try:
+        with open(path, encoding="utf-8", errors="surrogateescape") as vfile:
+            includes = INCLUDE_RE.findall(vfile.read())
+    except OSError:
+        return
+
+    for inc in includes:
+        for folder in [os.path.dirname(path), "", *incdirs]:
+            incfile = os.path.normpath(os.path.join(folder, inc))
+            if incfile not in sources and os.path.isfile(incfile):
+                sources.append(incfile)
+                get_includes(incfile, incdirs, sources)
+
+
+def get_sources(args, test):
+    """
+    Return the files a testbench executable depends on: the testbench,
+    svut_h.sv, the dot files and the files they list, and the files
+    included by all of them
+    """
+
+    sources = [test, "svut_h.sv"]
+    incdirs = list(args.include)
+
+    for dot in args.dotfile:
+        if not os.path.isfile(dot):
+            continue
+        sources.append(dot)
+        # Filesets may not be UTF-8 encoded. Escaped bytes map back to the same path
+        with open(dot, encoding="utf-8", errors="surrogateescape") as dotfile:
+            for token in dotfile.read().split():
+                if token.startswith("+incdir+"):
+                    incdirs += token[len("+incdir+"):].split("+")
+                elif not token.startswith(("-", "+", "//")):
+                    sources.append(token)
+
+    for src in list(sources):
+        if os.path.isfile(src):
+            get_includes(src, incdirs, sources)
+
+    return sources
+
+
+def build_is_up_to_date(target, cmd, sources):
+    """
+    Check the testbench executable target was built with cmd and is newer
+    than its sources. The build command is recorded in a stamp file once
+    the build succeeded, so an executable modified after its stamp comes
+    from another build
     """
-    simdefs = ""
 
-    if not defines:
-        return simdefs
+    stamp = target + ".cmd"
 
-    defs = defines.split(';')
+    try:
+        if os.path.getmtime(target) > os.path.getmtime(stamp):
+            return False
+        with open(stamp, encoding="utf-8") as stampfile:
+            if stampfile.read() != "\n".join(cmd):
+                return False
+        return not sources_newer_than(target, sources)
+    except OSError:
+        return False
 
-    for _def in defs:
-        if _def:
-            simdefs += "-D" + _def + " "
 
-    return simdefs
+def write_build_stamp(target, cmd):
+    """
+    Record the command which just built the testbench executable target
+    """
+
+    with open(target + ".cmd", "w", encoding="utf-8") as stampfile:
+        stampfile.write("\n".join(cmd))
+
+    return 0
 
 
 def create_iverilog(args, test):
     """
-    Create the Icarus Verilog command to launch the simulation
+    Create the Icarus Verilog commands to launch the simulation,
+    each one as a list of arguments. Also return the executable, its
+    build command and its sources, or None if no build is required
     """
 
     cmds = []
+    build = None
 
     if not os.path.isfile("svut.out"):
         print_event("Testbench executable not found. Will build it")
@@ -178,52 +310,58 @@ def create_iverilog(args, test):
     # Build testbench executable
     if not args.run_only:
 
-        cmd = "iverilog -g2012 -Wall -o svut.out "
+        cmd = [args.simulator_bin, "-g2012", "-Wall", "-o", "svut.out"]
 
-        if args.define:
-            cmd += get_defines(args.define)
+        cmd.extend(get_defines(args.define))
 
         if args.dotfile:
-
-            dotfiles = ""
-
             for dot in args.dotfile:
                 if os.path.isfile(dot):
-                    dotfiles += dot + " "
-
-            if dotfiles:
-                cmd += "-f " + dotfiles + " "
+                    cmd += ["-f", dot]
 
         if args.include:
-            incs = " ".join(args.include)
-            cmd += "-I " + incs + " "
+            for inc in args.include:
+                cmd += ["-I", inc]
 
-        cmd += test + " "
+        cmd.append(test)
+
+        build = ("svut.out", cmd, get_sources(args, test))
         cmds.append(cmd)
 
     # Execute testbench
     if not args.compile_only:
 
-        cmd = "vvp "
+        import shlex
+
+        cmd = [args.vvp_bin]
         if args.vpi:
-            cmd += args.vpi + " "
+            # Keep the quoting of the arguments, as a shell would
+            cmd += shlex.split(args.vpi)
 
-        cmd += "svut.out "
+        cmd.append("svut.out")
         cmds.append(cmd)
 
-    return cmds
+    return cmds, build
 
 
 def create_verilator(args, test):
     """
-    Create the Verilator command to launch the simulation
+    Create the Verilator commands to launch the simulation,
+    each one as a list of arguments. Also return the executable, its
+    build command and its sources, or None if no build is required
     """
 
-    testname = os.path.basename(test).split(".")[0]
+    testname = get_testname(test)
 
     cmds = []
+    build = None
 
-    if not os.path.isfile("build/V" + testname + ".mk"):
+    # Each testbench owns its build folder so several can be built concurrently.
+    # Testbenchs with the same name share it and are run one after the other
+    mdir = "build/" + testname
+    exe = mdir + "/V" + testname
+
+    if not os.path.isfile(mdir + "/V" + testname + ".mk"):
         print_event("Testbench executable not found. Will build it")
         args.run_only = False
 
@@ -231,71 +369,187 @@ def create_verilator(args, test):
     # Build testbench executable
     if not args.run_only:
 
-        cmd = """verilator -Wall --trace --Mdir build +1800-2012ext+sv """
-        cmd += """+1800-2005ext+v -Wno-STMTDLY -Wno-UNUSED -Wno-UNDRIVEN -Wno-PINCONNECTEMPTY """
-        cmd += """-Wpedantic -Wno-VARHIDDEN -Wno-lint """
+        cmd = [args.simulator_bin, *VERILATOR_FLAGS, "--Mdir", mdir]
 
-        if args.define:
-            cmd += get_defines(args.define)
+        cmd.extend(get_defines(args.define))
 
         if args.dotfile:
-
-            dotfiles = ""
-
             for dot in args.dotfile:
                 if os.path.isfile(dot):
-                    dotfiles += dot + " "
-
-            if dotfiles:
-                cmd += "-f " + dotfiles + " "
+                    cmd += ["-f", dot]
 
         if args.include:
             for inc in args.include:
-                cmd += "+incdir+" + inc + " "
+                cmd.append("+incdir+" + inc)
 
-        cmd += "-cc --exe --build -j --top-module " + testname + " "
-        cmd += test + " " + args.main
-        cmds.append(cmd)
+        cmd += ["--top-module", testname, test, args.main]
+
+        build = (exe, cmd, get_sources(args, test) + [args.main])
+        # The number of jobs doesn't change the executable, keep it out of the stamp
+        cmds.append(cmd + ["-j", str(args.jobs)])
 
     # Execution command
     if not args.compile_only:
-        cmd = "build/V" + testname
-        cmds.append(cmd)
+        cmds.append([exe])
 
-    return cmds
+    return cmds, build
 
 
-def print_event(event):
+def print_event(event, out=None):
     """
-    Print an event during SVUT execution
+    Print an event during SVUT execution, by default on stdout
     TODO: manage severity/verbosity level
     """
 
-    time = datetime.datetime.now().time().strftime('%H:%M:%S')
+    from datetime import datetime
+
+    now = datetime.now().time().strftime('%H:%M:%S')
 
-    print("SVUT (@ " + time + ") " + event, flush=True)
-    print("")
+    print("SVUT (@ " + now + ") " + event, file=out, flush=True)
+    print("", file=out)
 
     return 0
 
 
+def run_cmd(cmd, out):
+    """
+    Execute a command and stream its output into out, line by line.
+    Bytes which aren't valid UTF-8, like a raw $display, are replaced.
+    Return the command exit code
+    """
+
+    import subprocess
+
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          bufsize=1, text=True, encoding="utf-8",
+                          errors="replace") as proc:
+        for line in proc.stdout:
+            out.write(line)
+            out.flush()
+
+    return proc.returncode
+
+
+def run_test(args, test, cmds, build, out):
+    """
+    Execute one by one the commands of a testbench and log into out.
+    The build is skipped if the executable is up-to-date, and once it
+    succeeded, its command is recorded next to the executable.
+    Return 1 if a command failed, 0 otherwise
+    """
+
+    import shlex
+    from timeit import default_timer as timer
+    from datetime import timedelta
+
+    ret = 0
+    start = timer()
+
+    print_event("Start " + test, out)
+
+    for cmd in cmds:
+
+        # The build, if any, is always the first command. It's only checked now
+        # since the testbenchs run before may have rebuilt the same executable
+        if build and cmd is cmds[0] and build_is_up_to_date(*build):
+            print_event("Testbench executable up-to-date. Skip the build", out)
+            continue
+
+        # Quote the arguments so the command can be copied in a shell
+        print_event(shlex.join(cmd), out)
+
+        if not args.dry:
+            try:
+                cmdret = run_cmd(cmd, out)
+            except OSError as err:
+                print("ERROR: " + str(err), file=out)
+                cmdret = 1
+
+            if cmdret:
+                ret = 1
+                print("ERROR: Command failed: " + shlex.join(cmd), file=out)
+                break
+
+            # Without stamp the next execution builds again, the testbench can still run
+            if build and cmd is cmds[0]:
+                try:
+                    write_build_stamp(*build[:2])
+                except OSError as err:
+                    print("WARNING: Can't record the build command: " + str(err), file=out)
+
+    print_event("Stop " + test + " (elapsed time: " + str(timedelta(seconds=timer()-start)) + ")", out)
+
+    return ret
+
+
+def run_tests(args, tests, out):
+    """
+    Execute one after the other a list of testbenchs, described by their
+    path, commands and build, and log into out.
+    Return the number of testbenchs which failed
+    """
+
+    return sum(run_test(args, test, cmds, build, out) for test, cmds, build in tests)
+
+
+def get_git_key():
+    """
+    Return a key identifying the state of the SVUT clone: its location and
+    the last modification of its folder or of the git files a checkout,
+    a pull or a tag fetch update
+    """
+
+    paths = [SCRIPTDIR] + [os.path.join(SCRIPTDIR, ".git", name) for name in
+                           ("HEAD", "FETCH_HEAD", "index", "packed-refs", "refs/tags")]
+    mtime = max(os.stat(path).st_mtime_ns for path in paths if os.path.exists(path))
+
+    return SCRIPTDIR + ":" + str(mtime)
+
+
 def get_git_tag():
     """
-    Return current SVUT version
+    Return current SVUT version. The tag is cached for a short while to
+    avoid calling git on each execution
     """
 
-    curr_path = os.getcwd()
-    os.chdir(SCRIPTDIR)
+    import time
+
+    cache_file = os.path.expanduser("~/.cache/svut/git_tag")
+    git_key = get_git_key()
+
+    # The cache stores the state of the SVUT clone along the tag, to support
+    # several installs and drop the tag once the clone is updated
+    try:
+        if time.time() - os.path.getmtime(cache_file) < GIT_TAG_CACHE_TIMEOUT:
+            with open(cache_file, encoding="utf-8") as cache:
+                cache_key, git_tag = cache.read().split("\n")[:2]
+            if cache_key == git_key and git_tag:
+                return git_tag
+    except (OSError, ValueError):
+        pass
+
+    import subprocess
 
     try:
-        git_tag = subprocess.check_output(["git", "describe", "--tags", "--abbrev=0"])
+        git_tag = subprocess.check_output(["git", "describe", "--tags", "--abbrev=0"],
+                                          cwd=SCRIPTDIR, stderr=subprocess.DEVNULL)
         git_tag = git_tag.strip().decode('ascii')
     except subprocess.CalledProcessError as err:
         print("WARNING: Can't get last git tag. Will return v0.0.0")
-        git_tag = "v0.0.0"
         print(err.output)
+        # Not cached, the next execution tries again
+        return "v0.0.0"
+
+    # Write in a temporary file then rename it, other instances may read the cache
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + "." + str(os.getpid())
+        with open(tmp_file, "w", encoding="utf-8") as cache:
+            cache.write(git_key + "\n" + git_tag + "\n")
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
 
-    os.chdir(curr_path)
     return git_tag
 
 
@@ -305,7 +559,8 @@ if __name__ == '__main__':
 
     # SVUT options
 
-    PARSER.add_argument('-sim', dest='simulator', type=str, default="icarus",
+    PARSER.add_argument('-sim', dest='simulator', type=str.lower, default="icarus",
+                        choices=[*ICARUS, "verilator"],
                         help='The simulator to use, icarus or verilator.')
 
     PARSER.add_argument('-test', dest='test', type=str, default="all", nargs="*",
@@ -359,48 +614,76 @@ if __name__ == '__main__':
     if not ARGS.splash:
         print_banner(GIT_TAG)
 
-    # Lower the simulator name to ease checking
-    ARGS.simulator = ARGS.simulator.lower()
+    import io
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from timeit import default_timer as timer
+    from datetime import timedelta
+
     # Check arguments consistency
     check_arguments(ARGS)
 
     # If the user doesn't specify a path, scan the folder to execute all testbenchs
     if ARGS.test == "all":
         ARGS.test = find_unit_tests()
+        if not ARGS.test:
+            print_event("ERROR: No testbench found")
+            sys.exit(1)
 
     # Copy svut_h.sv if not present or not up-to-date
     copy_svut_h()
 
     cmdret = 0
 
-    for tests in ARGS.test:
+    # Testbenchs sharing an executable or a build folder run one after the other:
+    # Icarus always builds into svut.out, Verilator into build/<testname>
+    GROUPS = {}
 
+    for tests in ARGS.test:
         check_tb_extension(tests)
+        GROUP = "svut.out" if ARGS.simulator in ICARUS else get_testname(tests)
+        GROUPS.setdefault(GROUP, []).append(tests)
+
+    WORKERS = max(min(len(GROUPS), os.cpu_count() or 1), 1)
+
+    # Share the cores between the testbenchs built concurrently
+    ARGS.jobs = max((os.cpu_count() or 1) // WORKERS, 1)
+
+    # Prepare the commands of all the testbenchs before running them
+    for TESTS in GROUPS.values():
+
+        for i, tests in enumerate(TESTS):
+
+            if ARGS.simulator in ICARUS:
+                CMDS, BUILD = create_iverilog(ARGS, tests)
 
-        if "iverilog" in ARGS.simulator or "icarus" in ARGS.simulator:
-            CMDS = create_iverilog(ARGS, tests)
+            else:
+                CMDS, BUILD = create_verilator(ARGS, tests)
 
-        elif "verilator" in ARGS.simulator:
-            CMDS = create_verilator(ARGS, tests)
+            TESTS[i] = (tests, CMDS, BUILD)
 
-        start = timer()
-        print_event("Start " + tests)
+    total_start = timer()
 
-        # Execute commands one by one
-        for CMD in CMDS:
+    with ThreadPoolExecutor(max_workers=WORKERS) as EXECUTOR:
 
-            print_event(CMD)
+        LOGS = {}
 
-            if not ARGS.dry:
-                if os.system(CMD):
-                    cmdret += 1
-                    print("ERROR: Command failed: " + CMD)
-                    break
+        for TESTS in GROUPS.values():
+            # Buffer the log of concurrent testbenchs to print it in one block
+            LOG = sys.stdout if WORKERS <= 1 else io.StringIO()
+            LOGS[EXECUTOR.submit(run_tests, ARGS, TESTS, LOG)] = LOG
 
-        print_event("Stop " + tests)
+        for FUTURE in as_completed(LOGS):
+            # A failure in a worker must not drop the logs of the other testbenchs
+            try:
+                cmdret += FUTURE.result()
+            except Exception as err:  # pylint: disable=broad-except
+                cmdret += 1
+                print("ERROR: Testbench execution failed: " + repr(err), file=LOGS[FUTURE])
+            if LOGS[FUTURE] is not sys.stdout:
+                sys.stdout.write(LOGS[FUTURE].getvalue())
+                sys.stdout.flush()
 
-    end = timer()
-    print_event("Elapsed time: " + str(timedelta(seconds=end-start)))
+    print_event("Elapsed time: " + str(timedelta(seconds=timer()-total_start)))
     print()
 
     sys.exit(cmdret)
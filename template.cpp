@@ -1,4 +1,4 @@
-#include "build/V${name}_testbench.h"
+#include "V${name}_testbench.h"
 #include "verilated.h"
 
 int main(int argc, char** argv, char** env) {
@@ -49,6 +49,7 @@ clean() {
     rm -f ./Adder_testbench.sv
     rm -f files.f
     rm -f sim_main.cpp
+    rm -f svut.out svut.out.cmd
 }
 
 #------------------------------------------------------------------------------
@@ -34,3 +34,39 @@ test_run_ko_testsuite_error_count_failure() { #@test
 function exe_ko_to_log() {
     "$DIR/../svutRun" -test "$DIR/Adder_KO_testsuite.sv" | tee log
 }
+
+test_run_rerun_skips_build() { #@test
+
+    "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2"
+    run "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2"
+    [ "$status" -eq 0 ]
+    [ $(echo "$output" | grep -c "Skip the build") -eq 1 ]
+}
+
+test_run_define_change_rebuilds() { #@test
+
+    "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2"
+    run "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2;MYDEF3"
+    [ "$status" -eq 0 ]
+    [ $(echo "$output" | grep -c "Skip the build") -eq 0 ]
+}
+
+test_run_include_edit_rebuilds() { #@test
+
+    "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2"
+    # Adder.v is only pulled by an include of the testsuite
+    sleep 1
+    touch "$DIR/Adder.v"
+    run "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2"
+    [ "$status" -eq 0 ]
+    [ $(echo "$output" | grep -c "Skip the build") -eq 0 ]
+}
+
+test_run_latin1_fileset() { #@test
+
+    # A fileset comment with a Latin-1 byte, not valid UTF-8
+    printf '// caf\xe9 design\n' > latin1.f
+    run "$DIR/../svutRun" -test "$DIR/Adder_OK_testsuite.sv" -define "MYDEF1=5;MYDEF2" -f latin1.f
+    rm -f latin1.f
+    [ "$status" -eq 0 ]
+}
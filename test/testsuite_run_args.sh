@@ -19,7 +19,8 @@ test_run_all_with_compile_only() { #@test
 test_run_wrong_simulator() { #@test
 
     run "$DIR/../svutRun.py" "-sim" "xxx"
-    [ "$status" -eq 1 ]
+    # Rejected by argparse, which exits with 2 on usage errors
+    [ "$status" -eq 2 ]
 }
 
 test_run_version() { #@test
@@ -45,3 +46,15 @@ test_run_dry_run() { #@test
     run "$DIR/../svutRun.py" "-test" "../example/ffd_testbench.sv" "-dry-run"
     [ "$status" -eq 0 ]
 }
+
+test_run_all_no_tb_found() { #@test
+
+    run bash -c "cd $(mktemp -d) && $DIR/../svutRun.py"
+    [ "$status" -eq 1 ]
+}
+
+test_run_test_without_value() { #@test
+
+    run "$DIR/../svutRun.py" "-test"
+    [ "$status" -eq 1 ]
+}